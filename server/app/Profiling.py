@@ -0,0 +1,142 @@
+from types import FrameType
+from typing import Any, Counter, Deque, Dict, Iterator, List, Optional, Set
+
+import sys
+import threading
+import tracemalloc
+from collections import Counter as CounterType
+from collections import deque
+from contextlib import contextmanager
+from time import time
+
+DEFAULT_SAMPLING_INTERVAL = 0.005
+
+
+def _collapse_stack(frame: Optional[FrameType]) -> List[str]:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class StackSampler:
+    """
+    Wall-clock sampling profiler based on `sys._current_frames`.
+
+    Stacks of the sampled threads are aggregated in the "folded" format
+    (`thread;outer;...;inner count` per line) understood by flamegraph.pl,
+    speedscope and most other flamegraph tools.
+    """
+
+    def __init__(
+        self,
+        interval: float = DEFAULT_SAMPLING_INTERVAL,
+        thread_ids: Optional[Set[int]] = None,
+    ) -> None:
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.samples: Counter[str] = CounterType()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True
+        )
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if self.thread_ids is not None and thread_id not in self.thread_ids:
+                    continue
+                stack = [names.get(thread_id, str(thread_id)), *_collapse_stack(frame)]
+                self.samples[";".join(stack)] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stopped.set()
+        self._thread.join()
+        return self.folded()
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.samples.most_common())
+
+    def __enter__(self) -> "StackSampler":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+
+class AllocationTracker:
+    """
+    Per-stage tracemalloc snapshots of the `GraphStore` hot paths.
+
+    Stages are no-ops until `start` is called; afterwards every stage records
+    the net and peak allocated size and the lines that allocated the most.
+    """
+
+    def __init__(self, max_records: int = 100, top: int = 10) -> None:
+        self.top = top
+        self.records: Deque[Dict[str, Any]] = deque(maxlen=max_records)
+        self.active = False
+        self._lock = threading.RLock()
+
+    def start(self, frames: int = 1) -> None:
+        tracemalloc.start(frames)
+        self.active = True
+
+    def stop(self) -> None:
+        # Running stages need tracemalloc until they have taken their snapshot.
+        with self._lock:
+            self.active = False
+            tracemalloc.stop()
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if not self.active:
+            yield
+            return
+        # Snapshots and the peak counter are process-wide: serialize the stages.
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                # Stopped while waiting for the lock.
+                yield
+                return
+            before = self._snapshot()
+            tracemalloc.reset_peak()
+            size_before, _ = tracemalloc.get_traced_memory()
+            try:
+                yield
+            finally:
+                size_after, peak = tracemalloc.get_traced_memory()
+                stats = self._snapshot().compare_to(before, "lineno")[: self.top]
+                self.records.append(
+                    {
+                        "stage": name,
+                        "timestamp": int(time() * 1000),
+                        "size_diff_bytes": size_after - size_before,
+                        "peak_bytes": peak - size_before,
+                        "top": [
+                            {
+                                "location": str(stat.traceback),
+                                "size_diff_bytes": stat.size_diff,
+                                "count_diff": stat.count_diff,
+                            }
+                            for stat in stats
+                        ],
+                    }
+                )
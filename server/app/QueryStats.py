@@ -0,0 +1,129 @@
+from typing import Dict, List, Literal
+
+from dataclasses import dataclass
+from hashlib import sha1
+from re import DOTALL, Match, compile
+from threading import Lock
+
+from loguru import logger
+
+QueryKind = Literal["query", "update"]
+QueryStatsSortKey = Literal[
+    "total_time_ms", "max_time_ms", "mean_time_ms", "calls", "errors", "rows"
+]
+
+# Alternatives are tried left to right, so string literals and IRIs are consumed
+# before a "#" inside them could be mistaken for the start of a comment.
+_TOKEN_PATTERN = compile(
+    r'(?P<string>"""(?:.*?)"""|\'\'\'(?:.*?)\'\'\'|"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\')'
+    r"|(?P<iri><[^<>\"{}|^`\\\s]*>)"
+    r"|(?P<comment>#[^\n]*)"
+    r"|(?P<number>(?<![\w?$:])[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?(?![\w:]))",
+    DOTALL,
+)
+_WHITESPACE_PATTERN = compile(r"\s+")
+
+
+def _replace_token(match: Match[str]) -> str:
+    if match.lastgroup == "string":
+        return "'?'"
+    if match.lastgroup == "iri":
+        return "<?>"
+    if match.lastgroup == "comment":
+        return " "
+    return "?"
+
+
+def normalize_query(query: str) -> str:
+    """
+    Replace literals and IRIs with placeholders and collapse whitespace.
+
+    >>> normalize_query('SELECT * WHERE { <urn:a> ?p "x" . FILTER(?o > 5) } # c')
+    "SELECT * WHERE { <?> ?p '?' . FILTER(?o > ?) }"
+    """
+    normalized = _TOKEN_PATTERN.sub(_replace_token, query)
+    return _WHITESPACE_PATTERN.sub(" ", normalized).strip()
+
+
+def _digest(normalized_query: str) -> str:
+    return sha1(normalized_query.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class QueryStatsEntry:
+    fingerprint: str
+    kind: QueryKind
+    normalized_query: str
+    calls: int = 0
+    errors: int = 0
+    rows: int = 0
+    total_time_ms: float = 0.0
+    max_time_ms: float = 0.0
+
+    @property
+    def mean_time_ms(self) -> float:
+        return self.total_time_ms / self.calls if self.calls else 0.0
+
+
+class QueryStats:
+    """
+    In-process aggregates of SPARQL execution times keyed by query fingerprint.
+
+    Queries slower than `slow_query_threshold_ms` are logged in full.
+    The number of tracked fingerprints is bounded by `max_fingerprints`;
+    when the limit is reached the entry with the smallest total time is evicted.
+    """
+
+    def __init__(
+        self, slow_query_threshold_ms: float = 1000.0, max_fingerprints: int = 1000
+    ) -> None:
+        self.slow_query_threshold_ms = slow_query_threshold_ms
+        self.max_fingerprints = max_fingerprints
+        self._entries: Dict[str, QueryStatsEntry] = {}
+        self._lock = Lock()
+
+    def record(
+        self,
+        query: str,
+        kind: QueryKind,
+        elapsed_ms: float,
+        rows: int = 0,
+        error: bool = False,
+    ) -> QueryStatsEntry:
+        normalized = normalize_query(query)
+        fingerprint = _digest(normalized)
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                if len(self._entries) >= self.max_fingerprints:
+                    victim = min(self._entries.values(), key=lambda e: e.total_time_ms)
+                    del self._entries[victim.fingerprint]
+                entry = QueryStatsEntry(fingerprint, kind, normalized)
+                self._entries[fingerprint] = entry
+            entry.calls += 1
+            entry.rows += rows
+            entry.errors += int(error)
+            entry.total_time_ms += elapsed_ms
+            entry.max_time_ms = max(entry.max_time_ms, elapsed_ms)
+
+        if elapsed_ms >= self.slow_query_threshold_ms:
+            logger.warning(
+                f"Slow SPARQL {kind} [{fingerprint}] took {elapsed_ms:.1f} ms "
+                f"(rows={rows}, error={error}, calls={entry.calls}, "
+                f"max={entry.max_time_ms:.1f} ms):\n{query}"
+            )
+        return entry
+
+    def top(
+        self,
+        limit: int = 20,
+        sort_by: QueryStatsSortKey = "total_time_ms",
+    ) -> List[QueryStatsEntry]:
+        with self._lock:
+            entries = list(self._entries.values())
+        entries.sort(key=lambda e: getattr(e, sort_by), reverse=True)
+        return entries[:limit]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,257 @@
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from dataclasses import dataclass
+from re import compile
+
+import pyoxigraph
+
+ROLLUP_NAMESPACE = "http://glaciation-project.eu/metadata-service/rollup#"
+_XSD = "http://www.w3.org/2001/XMLSchema#"
+
+# Snapshot graphs are named `<prefix>timestamp:<ms>` by the ingestion endpoint,
+# rollup graphs `<prefix>rollup:<resolution ms>/timestamp:<bucket start ms>`.
+_SNAPSHOT_NAME_PATTERN = compile(r"^(.*?)(?:rollup:(\d+)/)?timestamp:(\d+)$")
+
+_AGGREGATE = pyoxigraph.NamedNode(ROLLUP_NAMESPACE + "aggregate")
+_PROPERTY = pyoxigraph.NamedNode(ROLLUP_NAMESPACE + "property")
+_MINIMUM = pyoxigraph.NamedNode(ROLLUP_NAMESPACE + "min")
+_MAXIMUM = pyoxigraph.NamedNode(ROLLUP_NAMESPACE + "max")
+_AVERAGE = pyoxigraph.NamedNode(ROLLUP_NAMESPACE + "avg")
+_COUNT = pyoxigraph.NamedNode(ROLLUP_NAMESPACE + "count")
+_XSD_DOUBLE = pyoxigraph.NamedNode(_XSD + "double")
+_XSD_INTEGER = pyoxigraph.NamedNode(_XSD + "integer")
+_NUMERIC_DATATYPES = {
+    pyoxigraph.NamedNode(_XSD + name)
+    for name in (
+        "integer",
+        "decimal",
+        "double",
+        "float",
+        "long",
+        "int",
+        "short",
+        "byte",
+        "nonNegativeInteger",
+        "nonPositiveInteger",
+        "positiveInteger",
+        "negativeInteger",
+        "unsignedLong",
+        "unsignedInt",
+        "unsignedShort",
+        "unsignedByte",
+    )
+}
+
+Subject = Union[pyoxigraph.NamedNode, pyoxigraph.BlankNode, pyoxigraph.Triple]
+
+
+@dataclass(frozen=True)
+class RollupTier:
+    """Merge the graphs older than `older_than_ms` into `resolution_ms` buckets."""
+
+    older_than_ms: int
+    resolution_ms: int
+
+
+@dataclass
+class RollupResult:
+    resolution_ms: int
+    source_graphs: int = 0
+    rollup_graphs: int = 0
+    source_triples: int = 0
+    rollup_triples: int = 0
+
+
+def parse_snapshot_name(graph_name: str) -> Optional[Tuple[str, int, int]]:
+    """
+    Split a snapshot or rollup graph name into its prefix, resolution and start.
+
+    Snapshots have a resolution of 0.
+
+    >>> parse_snapshot_name("timestamp:1700000000000")
+    ('', 0, 1700000000000)
+    >>> parse_snapshot_name("http://glaciation-project.eu/a/rollup:3600000/timestamp:0")
+    ('http://glaciation-project.eu/a/', 3600000, 0)
+    >>> parse_snapshot_name("urn:other") is None
+    True
+    """
+    found = _SNAPSHOT_NAME_PATTERN.match(graph_name)
+    if not found:
+        return None
+    return found.group(1), int(found.group(2) or 0), int(found.group(3))
+
+
+def rollup_graph_name(prefix: str, resolution_ms: int, start: int) -> str:
+    """
+    >>> rollup_graph_name("", 3600000, 1699999200000)
+    'rollup:3600000/timestamp:1699999200000'
+    """
+    return f"{prefix}rollup:{resolution_ms}/timestamp:{start}"
+
+
+def validate_tiers(tiers: Sequence[RollupTier]) -> List[RollupTier]:
+    """
+    Order the tiers from the finest to the coarsest resolution.
+
+    Every resolution must be a multiple of the previous one so that the buckets
+    of a tier are made of whole buckets of the tier below.
+    """
+    ordered = sorted(tiers, key=lambda tier: tier.resolution_ms)
+    previous = None
+    for tier in ordered:
+        if tier.resolution_ms <= 0 or tier.older_than_ms < 0:
+            raise ValueError(f"Invalid rollup tier {tier}")
+        if previous is not None:
+            if tier.resolution_ms % previous.resolution_ms:
+                raise ValueError(
+                    f"Rollup resolution {tier.resolution_ms} ms is not a multiple "
+                    f"of {previous.resolution_ms} ms"
+                )
+            if tier.older_than_ms < previous.older_than_ms:
+                raise ValueError(
+                    "Coarser rollup tiers must not apply to younger graphs "
+                    f"than finer ones: {tier} < {previous}"
+                )
+        previous = tier
+    return ordered
+
+
+def _numeric_value(term: pyoxigraph.Literal) -> Optional[float]:
+    if term.datatype not in _NUMERIC_DATATYPES:
+        return None
+    try:
+        return float(term.value)
+    except ValueError:
+        return None
+
+
+@dataclass
+class _Aggregate:
+    minimum: pyoxigraph.Literal
+    maximum: pyoxigraph.Literal
+    total: float
+    count: int
+
+    @classmethod
+    def of(cls, value: pyoxigraph.Literal) -> "_Aggregate":
+        return cls(value, value, float(value.value), 1)
+
+    def merge(self, other: "_Aggregate") -> None:
+        if float(other.minimum.value) < float(self.minimum.value):
+            self.minimum = other.minimum
+        if float(other.maximum.value) > float(self.maximum.value):
+            self.maximum = other.maximum
+        self.total += other.total
+        self.count += other.count
+
+
+class SnapshotMerger:
+    """
+    Merge the triples of snapshot and rollup graphs into one rollup graph.
+
+    Triples that do not change between the graphs are kept once. Numeric
+    literals are aggregated per subject and predicate: the rollup keeps
+    `?s ?p <average>` (or the value itself if it never changed) and, if it
+    merges more than one value, describes the aggregate with a blank node:
+
+        ?s rollup:aggregate [
+            rollup:property ?p ; rollup:min ... ; rollup:max ... ;
+            rollup:avg ... ; rollup:count ...
+        ]
+
+    Merging rollup graphs combines their aggregates, so tiers can be stacked;
+    a value without a description counts once. Blank nodes of the source graphs
+    cannot be matched across graphs, so their triples are copied as they are
+    and never aggregated.
+    """
+
+    def __init__(self) -> None:
+        self.source_triples = 0
+        self._triples: Set[pyoxigraph.Triple] = set()
+        self._aggregates: Dict[Tuple[Subject, pyoxigraph.NamedNode], _Aggregate] = {}
+
+    def add_graph(self, triples: Iterable[pyoxigraph.Triple]) -> None:
+        triples = list(triples)
+        self.source_triples += len(triples)
+        aggregate_nodes = {t.object for t in triples if t.predicate == _AGGREGATE}
+        descriptions: Dict[Any, Dict[pyoxigraph.NamedNode, Any]] = {
+            node: {} for node in aggregate_nodes
+        }
+        for t in triples:
+            if t.subject in descriptions:
+                descriptions[t.subject][t.predicate] = t.object
+
+        summarized = set()
+        for t in triples:
+            if t.predicate != _AGGREGATE:
+                continue
+            description = descriptions[t.object]
+            key = (t.subject, description[_PROPERTY])
+            count = int(description[_COUNT].value)
+            average = float(description[_AVERAGE].value)
+            self._aggregate(
+                key,
+                _Aggregate(
+                    description[_MINIMUM],
+                    description[_MAXIMUM],
+                    average * count,
+                    count,
+                ),
+            )
+            summarized.add(key)
+
+        for t in triples:
+            if t.subject in descriptions or t.predicate == _AGGREGATE:
+                continue
+            key = (t.subject, t.predicate)
+            if (
+                isinstance(t.subject, pyoxigraph.BlankNode)
+                or not isinstance(t.object, pyoxigraph.Literal)
+                or _numeric_value(t.object) is None
+            ):
+                self._triples.add(t)
+            elif key not in summarized:
+                self._aggregate(key, _Aggregate.of(t.object))
+
+    def _aggregate(
+        self, key: Tuple[Subject, pyoxigraph.NamedNode], aggregate: _Aggregate
+    ) -> None:
+        if key in self._aggregates:
+            self._aggregates[key].merge(aggregate)
+        else:
+            self._aggregates[key] = aggregate
+
+    def merged(self) -> Iterator[pyoxigraph.Triple]:
+        yield from self._triples
+        for (subject, predicate), aggregate in self._aggregates.items():
+            average = pyoxigraph.Literal(
+                repr(aggregate.total / aggregate.count), datatype=_XSD_DOUBLE
+            )
+            value = (
+                aggregate.minimum if aggregate.minimum == aggregate.maximum else average
+            )
+            yield pyoxigraph.Triple(subject, predicate, value)
+            if aggregate.count == 1:
+                continue
+            node = pyoxigraph.BlankNode()
+            yield pyoxigraph.Triple(subject, _AGGREGATE, node)
+            yield pyoxigraph.Triple(node, _PROPERTY, predicate)
+            yield pyoxigraph.Triple(node, _MINIMUM, aggregate.minimum)
+            yield pyoxigraph.Triple(node, _MAXIMUM, aggregate.maximum)
+            yield pyoxigraph.Triple(node, _AVERAGE, average)
+            yield pyoxigraph.Triple(
+                node,
+                _COUNT,
+                pyoxigraph.Literal(str(aggregate.count), datatype=_XSD_INTEGER),
+            )
@@ -0,0 +1,48 @@
+from typing import Dict, Iterator
+
+from contextlib import contextmanager
+from time import perf_counter
+
+from loguru import logger
+from prometheus_client import Gauge
+
+STARTUP_PHASE_SECONDS = Gauge(
+    "metadata_service_startup_phase_seconds",
+    "Duration of the service startup phases",
+    ["phase"],
+)
+READY = Gauge(
+    "metadata_service_ready",
+    "1 once the graph store is open and the optional warmup has finished",
+)
+
+
+class StartupState:
+    """Readiness flag and per-phase timings of the service startup."""
+
+    def __init__(self) -> None:
+        self.ready = False
+        self.phases: Dict[str, float] = {}
+        self._started = perf_counter()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            self.phases[name] = elapsed
+            STARTUP_PHASE_SECONDS.labels(phase=name).set(elapsed)
+            logger.info(f"Startup phase '{name}' took {elapsed * 1000:.1f} ms")
+
+    def mark_ready(self) -> None:
+        total = perf_counter() - self._started
+        self.phases["total"] = total
+        STARTUP_PHASE_SECONDS.labels(phase="total").set(total)
+        self.ready = True
+        READY.set(1)
+        breakdown = ", ".join(
+            f"{name}={elapsed * 1000:.1f} ms" for name, elapsed in self.phases.items()
+        )
+        logger.info(f"Service is ready: {breakdown}")
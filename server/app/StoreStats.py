@@ -0,0 +1,171 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bisect import bisect_left, insort
+from re import compile
+from threading import Lock
+
+from prometheus_client import Gauge
+
+_GRAPH_NAME_PATTERN = compile(r"^(.*?)/?(?:rollup:\d+/)?timestamp:(\d+)$")
+
+STORE_QUADS = Gauge("metadata_service_store_quads", "Number of quads in the store")
+STORE_GRAPHS = Gauge(
+    "metadata_service_store_graphs", "Number of non-empty named graphs in the store"
+)
+STORE_GRAPHS_BY_RESOURCE = Gauge(
+    "metadata_service_store_graphs_by_resource",
+    "Number of snapshot graphs per resource @id",
+    ["resource"],
+)
+STORE_OLDEST_TIMESTAMP = Gauge(
+    "metadata_service_store_oldest_timestamp_milliseconds",
+    "Timestamp of the oldest snapshot graph (0 if there is none)",
+)
+STORE_NEWEST_TIMESTAMP = Gauge(
+    "metadata_service_store_newest_timestamp_milliseconds",
+    "Timestamp of the newest snapshot graph (0 if there is none)",
+)
+
+
+def parse_graph_name(graph_name: str) -> Tuple[str, Optional[int]]:
+    """
+    Split a snapshot or rollup graph name into the resource @id and its timestamp.
+
+    >>> parse_graph_name("http://glaciation-project.eu/node/a/timestamp:1700000000000")
+    ('http://glaciation-project.eu/node/a', 1700000000000)
+    >>> parse_graph_name("http://glaciation-project.eu/node/a/rollup:60000/timestamp:0")
+    ('http://glaciation-project.eu/node/a', 0)
+    >>> parse_graph_name("urn:other")
+    ('urn:other', None)
+    """
+    found = _GRAPH_NAME_PATTERN.match(graph_name)
+    if found:
+        return found.group(1), int(found.group(2))
+    return graph_name, None
+
+
+class StoreStats:
+    """
+    Per-graph triple counts kept up to date by the writers of the store.
+
+    Nothing here reads from the store: `GraphStore` reports the effect of every
+    write and rebuilds the counts with a single scan when that is not possible.
+    Named graphs are keyed by IRI; the default graph is tracked separately.
+    """
+
+    def __init__(self, export_metrics: bool = False) -> None:
+        self.initialized = False
+        self.default_graph_triples = 0
+        self._graph_triples: Dict[str, int] = {}
+        self._graphs_by_resource: Dict[str, int] = {}
+        # Sorted timestamps of the snapshot graphs, one per graph.
+        self._timestamps: List[int] = []
+        self._total_quads = 0
+        self._export_metrics = export_metrics
+        self._lock = Lock()
+        if export_metrics:
+            STORE_QUADS.set_function(lambda: self.total_quads)
+            STORE_GRAPHS.set_function(lambda: self.graph_count)
+            STORE_OLDEST_TIMESTAMP.set_function(lambda: self.timestamp_range()[0] or 0)
+            STORE_NEWEST_TIMESTAMP.set_function(lambda: self.timestamp_range()[1] or 0)
+
+    @property
+    def total_quads(self) -> int:
+        return self._total_quads
+
+    @property
+    def graph_count(self) -> int:
+        return len(self._graph_triples)
+
+    def has_graph(self, graph_name: str) -> bool:
+        return graph_name in self._graph_triples
+
+    def graph_triples(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._graph_triples)
+
+    def graphs_by_resource(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._graphs_by_resource)
+
+    def timestamp_range(self) -> Tuple[Optional[int], Optional[int]]:
+        with self._lock:
+            if not self._timestamps:
+                return None, None
+            return self._timestamps[0], self._timestamps[-1]
+
+    def rebuild(
+        self, graph_triples: Iterable[Tuple[str, int]], default_graph_triples: int
+    ) -> None:
+        with self._lock:
+            for resource in self._graphs_by_resource:
+                self._export_resource(resource, 0)
+            self._graph_triples.clear()
+            self._graphs_by_resource.clear()
+            self._timestamps.clear()
+            self._total_quads = 0
+            self._set_default_graph(default_graph_triples)
+            for graph_name, n_triples in graph_triples:
+                self._set_graph(graph_name, n_triples)
+            self.initialized = True
+
+    def set_graph(self, graph_name: str, n_triples: int) -> None:
+        with self._lock:
+            self._set_graph(graph_name, n_triples)
+
+    def add_to_graph(self, graph_name: str, n_triples: int) -> None:
+        with self._lock:
+            current = self._graph_triples.get(graph_name, 0)
+            self._set_graph(graph_name, current + n_triples)
+
+    def drop_graph(self, graph_name: str) -> None:
+        self.set_graph(graph_name, 0)
+
+    def set_default_graph(self, n_triples: int) -> None:
+        with self._lock:
+            self._set_default_graph(n_triples)
+
+    def invalidate(self) -> None:
+        """Mark the counts as unknown until they are rebuilt."""
+        self.initialized = False
+
+    def _set_default_graph(self, n_triples: int) -> None:
+        self._total_quads += n_triples - self.default_graph_triples
+        self.default_graph_triples = n_triples
+
+    def _set_graph(self, graph_name: str, n_triples: int) -> None:
+        previous = self._graph_triples.get(graph_name, 0)
+        self._total_quads += n_triples - previous
+        if previous and not n_triples:
+            del self._graph_triples[graph_name]
+            self._count_resource(graph_name, -1)
+        elif n_triples:
+            self._graph_triples[graph_name] = n_triples
+            if not previous:
+                self._count_resource(graph_name, 1)
+
+    def _count_resource(self, graph_name: str, delta: int) -> None:
+        resource, timestamp = parse_graph_name(graph_name)
+        if timestamp is None:
+            return
+        if delta > 0:
+            insort(self._timestamps, timestamp)
+        else:
+            del self._timestamps[bisect_left(self._timestamps, timestamp)]
+        count = self._graphs_by_resource.get(resource, 0) + delta
+        if count:
+            self._graphs_by_resource[resource] = count
+        else:
+            self._graphs_by_resource.pop(resource, None)
+        self._export_resource(resource, count)
+
+    def _export_resource(self, resource: str, count: int) -> None:
+        if not self._export_metrics:
+            return
+        if count:
+            STORE_GRAPHS_BY_RESOURCE.labels(resource=resource).set(count)
+        else:
+            try:
+                STORE_GRAPHS_BY_RESOURCE.remove(resource)
+            except KeyError:
+                pass
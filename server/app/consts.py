@@ -6,6 +6,8 @@ from app.schemas import ResponseHead, ResponseResults, SearchResponse
 class TagEnum(Enum):
     GRAPH = "Graph"
     MONITORING = "Monitoring"
+    STORE = "Store"
+    ADMIN = "Admin"
 
 
 EMPTY_SEARCH_RESPONSE = SearchResponse(
@@ -1,13 +1,12 @@
 # the script should talk to metadata service directly
 # it should retrieve the time stamps
 
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 from datetime import datetime, timedelta
 from os import getenv
 from re import search
 from time import sleep
-from urllib.parse import urlencode
 
 import requests
 import schedule
@@ -18,10 +17,19 @@ INTERVAL_TO_CHECK_IN_SECONDS = int(float(getenv("INTERVAL_TO_CHECK_IN_SECONDS",
 COMPACTION_INTERVAL_IN_SECONDS = int(
     float(getenv("COMPACTION_INTERVAL_IN_SECONDS", "3600"))
 )
+# Comma-separated "<older than ms>:<resolution ms>" tiers; empty disables rollups.
+ROLLUP_TIERS = getenv("ROLLUP_TIERS", "")
+ROLLUP_INTERVAL_IN_SECONDS = int(float(getenv("ROLLUP_INTERVAL_IN_SECONDS", "600")))
+ROLLUP_RETENTION_MILLISECONDS = int(
+    float(getenv("ROLLUP_RETENTION_MILLISECONDS", "604800000"))
+)
 _REQUEST_TIMEOUT = int(float(getenv("REQUEST_TIMEOUT_SECONDS", "30")))
+_ROLLUP_TIMEOUT = int(float(getenv("ROLLUP_TIMEOUT_SECONDS", "600")))
 _MAX_RETRIES = int(float(getenv("MAX_RETRIES", "3")))
 _RETRY_BASE_DELAY = float(getenv("RETRY_BASE_DELAY", "1.0"))
 
+_session = requests.Session()
+
 
 def read_file(fname):
     with open(fname, "r") as f:
@@ -32,15 +40,15 @@ def local_query(query: str, update_query: bool = False) -> Any:
     """
     Queries Local Metadata service
     """
-    params = {"query": query}
-    encoded_query = urlencode(params)
     base_url = "http://localhost:80/api/v0/graph"  # Address of the Metadata Service!
-    if update_query:
-        base_url += "/update"
-    full_url = f"{base_url}?{encoded_query}"
+    # POST bodies are not limited in length like URLs, which matters for the
+    # long lists of DROP GRAPH statements; the session reuses the connection.
+    base_url += "/update" if update_query else "/query"
 
     try:
-        response = requests.get(full_url, timeout=_REQUEST_TIMEOUT)
+        response = _session.post(
+            base_url, json={"query": query}, timeout=_REQUEST_TIMEOUT
+        )
         response.raise_for_status()
         return response.json()
     except Exception as e:
@@ -69,7 +77,7 @@ def compaction() -> None:
 
     for attempt in range(_MAX_RETRIES):
         try:
-            response = requests.post(url, timeout=_REQUEST_TIMEOUT)
+            response = _session.post(url, timeout=_REQUEST_TIMEOUT)
             if response.status_code == 200:
                 logger.info("Compaction triggered successfully!")
                 logger.debug(response.text)
@@ -87,6 +95,41 @@ def compaction() -> None:
     logger.error(f"Compaction gave up after {_MAX_RETRIES} attempts.")
 
 
+def parse_rollup_tiers(spec: str) -> List[Dict[str, int]]:
+    """
+    >>> parse_rollup_tiers("3600000:60000, 86400000:3600000")[1]
+    {'older_than_ms': 86400000, 'resolution_ms': 3600000}
+    """
+    tiers = []
+    for tier in filter(None, (t.strip() for t in spec.split(","))):
+        older_than_ms, resolution_ms = tier.split(":")
+        tiers.append(
+            {
+                "older_than_ms": int(float(older_than_ms)),
+                "resolution_ms": int(float(resolution_ms)),
+            }
+        )
+    return tiers
+
+
+def rollup() -> None:
+    url = "http://localhost:80/api/v0/store/rollup"
+
+    try:
+        response = _session.post(
+            url,
+            json={
+                "tiers": parse_rollup_tiers(ROLLUP_TIERS),
+                "retention_ms": ROLLUP_RETENTION_MILLISECONDS,
+            },
+            timeout=_ROLLUP_TIMEOUT,
+        )
+        response.raise_for_status()
+        logger.info(f"Rollup finished: {response.json()}")
+    except Exception as e:
+        logger.exception(f"Rollup failed: {e}")
+
+
 def job():
     timestamps = get_timestamps()
 
@@ -111,6 +154,8 @@ def job():
 
 schedule.every(INTERVAL_TO_CHECK_IN_SECONDS).seconds.do(job)
 schedule.every(COMPACTION_INTERVAL_IN_SECONDS).seconds.do(compaction)
+if ROLLUP_TIERS:
+    schedule.every(ROLLUP_INTERVAL_IN_SECONDS).seconds.do(rollup)
 
 if __name__ == "__main__":
     while True:
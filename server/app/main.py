@@ -1,6 +1,10 @@
-from typing import Any, Dict
+from typing import Any, AsyncIterator, Dict
+
+from asyncio import Task, create_task
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.openapi.utils import get_openapi
 from prometheus_fastapi_instrumentator import Instrumentator
 
@@ -31,8 +35,35 @@ class CustomFastAPI(FastAPI):
         return self.openapi_schema
 
 
-app = CustomFastAPI()
+_background_tasks: set[Task[None]] = set()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Open the store before serving and warm it up in the background."""
+    with routers.startup_state.phase("open_store"):
+        await run_in_threadpool(routers.store.open)
+    # Readiness does not wait for the statistics, writes during the scan are
+    # accounted for once it is done.
+    routers.store.load_statistics()
+    if routers.WARMUP_ON_STARTUP:
+        # On the loop, before serving: the parsers are not safe to build
+        # concurrently with requests. It only takes about 100 ms.
+        routers.warmup_parsers()
+        task = create_task(run_in_threadpool(routers.warmup))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    else:
+        routers.startup_state.mark_ready()
+    yield
+
+
+app = CustomFastAPI(lifespan=lifespan)
 app.include_router(routers.router)
+app.include_router(routers.monitoring_router)
+app.include_router(routers.store_router)
+app.include_router(routers.admin_router)
+app.add_middleware(routers.ProfileRequestMiddleware)
 
 
 Instrumentator().instrument(app).expose(app, tags=[TagEnum.MONITORING])
@@ -1,51 +1,135 @@
-from typing import Any, Callable
+from typing import (
+    Annotated,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Tuple,
+)
 
+import asyncio
+import threading
+import tracemalloc
+from dataclasses import asdict
+from functools import partial
 from glob import glob
 from json import dump, dumps
 from os import getenv, makedirs, path, remove
 from re import findall, sub
-from time import sleep, time
+from secrets import compare_digest
+from tempfile import NamedTemporaryFile
+from time import perf_counter, sleep, time
 
-from fastapi import APIRouter, HTTPException
+import pyoxigraph
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from loguru import logger
-from starlette.responses import RedirectResponse
+from starlette.datastructures import Headers
+from starlette.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 from starlette.status import (
     HTTP_303_SEE_OTHER,
     HTTP_400_BAD_REQUEST,
+    HTTP_403_FORBIDDEN,
+    HTTP_404_NOT_FOUND,
+    HTTP_409_CONFLICT,
     HTTP_500_INTERNAL_SERVER_ERROR,
+    HTTP_503_SERVICE_UNAVAILABLE,
 )
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from app.consts import TagEnum
-from app.GraphStore import GraphStore
+from app.GraphStore import (
+    NDJSON_MIME_TYPE,
+    NQUADS_MIME_TYPE,
+    RDF_MIME_TYPES,
+    GraphStore,
+    serialize_solutions_ndjson,
+    serialize_triples,
+)
+from app.Profiling import StackSampler
+from app.QueryStats import QueryKind, QueryStats, QueryStatsSortKey
+from app.Rollup import RollupTier
 from app.schemas import (
+    AllocationRecord,
+    AllocationsResponse,
+    AskResponse,
+    ExportGraphs,
+    QueryStatsItem,
+    QueryStatsResponse,
+    RDFFormat,
+    ReadinessResponse,
     ResponseHead,
     ResponseResults,
+    RollupRequest,
+    RollupResponse,
+    RollupTierResult,
     SearchResponse,
+    SearchSPARQLQuery,
+    SearchSPARQLQueryBody,
     SPARQLQuery,
+    StoreStatsResponse,
     UpdateRequestBody,
     UpdateSPARQLQuery,
 )
+from app.StartupState import StartupState
 
 router = APIRouter(tags=[TagEnum.GRAPH])
+monitoring_router = APIRouter(tags=[TagEnum.MONITORING])
+store_router = APIRouter(tags=[TagEnum.STORE])
 
 STORE_PATH = getenv("STORE_PATH")
+BACKUP_PATH = getenv("BACKUP_PATH") or (
+    f"{STORE_PATH.rstrip('/')}-backups" if STORE_PATH else None
+)
 _MAX_RETRIES = int(getenv("MAX_RETRIES", "3"))
 _RETRY_BASE_DELAY = float(getenv("RETRY_BASE_DELAY", "1.0"))
-store = GraphStore(STORE_PATH)
+_SLOW_QUERY_THRESHOLD_MS = float(getenv("SLOW_QUERY_THRESHOLD_MS", "1000"))
+_QUERY_STATS_MAX_FINGERPRINTS = int(getenv("QUERY_STATS_MAX_FINGERPRINTS", "1000"))
+WARMUP_ON_STARTUP = getenv("WARMUP_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+PROFILING_ENABLED = getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+ADMIN_TOKEN = getenv("ADMIN_TOKEN")
+store = GraphStore(STORE_PATH, export_metrics=True)
+query_stats = QueryStats(_SLOW_QUERY_THRESHOLD_MS, _QUERY_STATS_MAX_FINGERPRINTS)
+startup_state = StartupState()
+
+QUERY_FILES_DIRNAME = path.join(path.dirname(__file__), "query_files")
 
 HISTORY_FILES_DIRNAME = "history_files/"
 N_HISTORY_FILES = 10
 JSON_LD_OUTPUT_FILE = "incoming_json_ld_{timestamp}.jsonld"
 
 
-def _sparql_with_retry(fn: Callable[[], Any], description: str = "SPARQL") -> Any:
-    """Run a GraphStore call with exponential-backoff retries."""
+def _sparql_with_retry(
+    fn: Callable[[], Any],
+    description: str = "SPARQL",
+    query: str | None = None,
+    kind: QueryKind = "query",
+) -> Tuple[Any, float]:
+    """
+    Run a GraphStore call with exponential-backoff retries.
+
+    Returns the result with the `perf_counter` start of the successful attempt,
+    so that callers do not count the backoff as execution time. Failed attempts
+    of `query` are recorded in the query statistics one by one.
+    """
     last_exc: Exception = RuntimeError("unreachable")
     for attempt in range(_MAX_RETRIES):
+        start = perf_counter()
         try:
-            return fn()
+            return fn(), start
         except Exception as e:
             last_exc = e
+            if query is not None:
+                elapsed_ms = (perf_counter() - start) * 1000
+                query_stats.record(query, kind, elapsed_ms, error=True)
             if attempt < _MAX_RETRIES - 1:
                 delay = _RETRY_BASE_DELAY * (2**attempt)
                 logger.warning(
@@ -56,6 +140,30 @@ def _sparql_with_retry(fn: Callable[[], Any], description: str = "SPARQL") -> An
     raise last_exc
 
 
+def warmup_parsers() -> None:
+    """
+    Build rdflib's grammars and parser plugins.
+
+    pyparsing initializes a grammar on its first use in a way that is not
+    thread-safe, so this must run before requests are served rather than
+    concurrently with them.
+    """
+    with startup_state.phase("warmup_parsers"):
+        store.warmup()
+
+
+def warmup() -> None:
+    """Run the registered queries once; call `warmup_parsers` first."""
+    try:
+        with startup_state.phase("warmup_queries"):
+            for fname in sorted(glob(path.join(QUERY_FILES_DIRNAME, "*.txt"))):
+                with open(fname, "r") as f:
+                    store.read_query(f.read())
+    except Exception:
+        logger.exception("Warmup failed; serving requests without it.")
+    startup_state.mark_ready()
+
+
 def cleanup_old_files(directory, pattern, max_files):
     """Keeps only the latest 'max_files' files in 'directory' and deletes older ones."""
     files = sorted(glob(path.join(directory, pattern)), key=path.getmtime, reverse=True)
@@ -125,39 +233,186 @@ async def update_graph(
     return f"Success - Inserted {n_triples} triple(s) into graph <{graph_name}>."
 
 
-@router.get(
-    "/api/v0/graph",
-)
-async def search_graph(
-    query: SPARQLQuery,
-) -> SearchResponse:
-    """Execute SPARQL search query and return a response in JSON format."""
+def _rdf_mime_type(format: str | None, accept: str | None) -> str:
+    if format is not None:
+        return RDF_MIME_TYPES[format]
+    for media_range in (accept or "").split(","):
+        media_type = media_range.split(";")[0].strip()
+        if media_type in RDF_MIME_TYPES.values():
+            return media_type
+    return RDF_MIME_TYPES["ntriples"]
+
+
+def _accepts(accept: str | None, mime_type: str) -> bool:
+    return any(
+        media_range.split(";")[0].strip() == mime_type
+        for media_range in (accept or "").split(",")
+    )
+
+
+def _stream_results(
+    query: str,
+    items: Iterable[Any],
+    serialize: Callable[[Iterable[Any]], Iterator[bytes]],
+    start: float,
+) -> AsyncIterator[bytes]:
+    """
+    Serialize lazily produced query results, recording the stats once sent.
+
+    Chunks are produced up to the first result before returning, so that
+    errors in the early evaluation of the query still fail the request
+    instead of truncating a response already sent with status 200.
+
+    pyoxigraph query results must be consumed on the thread that created them,
+    so the rest is streamed by an async generator run by the event loop rather
+    than a sync one that Starlette would iterate in its thread pool.
+    """
+    rows = 0
+
+    def counted() -> Iterator[Any]:
+        nonlocal rows
+        for item in items:
+            rows += 1
+            yield item
+
+    chunks = serialize(counted())
+    prefetched = []
+    try:
+        for chunk in chunks:
+            prefetched.append(chunk)
+            if rows:
+                break
+    except Exception:
+        query_stats.record(query, "query", (perf_counter() - start) * 1000, error=True)
+        raise
+
+    async def stream() -> AsyncIterator[bytes]:
+        error = False
+        try:
+            for chunk in prefetched:
+                yield chunk
+            for chunk in chunks:
+                yield chunk
+        except Exception:
+            error = True
+            logger.exception("Streaming query results failed")
+            raise
+        finally:
+            elapsed_ms = (perf_counter() - start) * 1000
+            query_stats.record(query, "query", elapsed_ms, rows, error)
+
+    return stream()
+
+
+def _search(
+    query: str, format: str | None, accept: str | None
+) -> Response | SearchResponse:
     valid, msg = store.validate_sparql(query, "query")
 
-    if valid:
-        try:
-            result = _sparql_with_retry(lambda: store.read_query(query), "SPARQL read")
-            logger.debug(f"Found {len(result['bindings'])} result(s).")
-            return SearchResponse(
-                head=ResponseHead(vars=result["vars"]),
-                results=ResponseResults(bindings=result["bindings"]),
-            )
-        except Exception as e:
-            raise HTTPException(HTTP_500_INTERNAL_SERVER_ERROR, str(e))
-    else:
+    if not valid:
         logger.error(msg)
         logger.debug(f"The query:\n{query}")
         raise HTTPException(HTTP_400_BAD_REQUEST, msg)
 
+    stream_solutions = _accepts(accept, NDJSON_MIME_TYPE)
+    try:
+        result, start = _sparql_with_retry(
+            lambda: store.query(query, stream_solutions), "SPARQL read", query
+        )
+    except Exception as e:
+        raise HTTPException(HTTP_500_INTERNAL_SERVER_ERROR, str(e))
+
+    if isinstance(result, bool):
+        query_stats.record(query, "query", (perf_counter() - start) * 1000)
+        return JSONResponse(AskResponse(head={}, boolean=result).model_dump())
+
+    if isinstance(result, dict):
+        n_rows = len(result["bindings"])
+        query_stats.record(query, "query", (perf_counter() - start) * 1000, n_rows)
+        logger.debug(f"Found {n_rows} result(s).")
+        return SearchResponse(
+            head=ResponseHead(vars=result["vars"]),
+            results=ResponseResults(bindings=result["bindings"]),
+        )
+
+    if isinstance(result, pyoxigraph.QuerySolutions):
+        mime_type = NDJSON_MIME_TYPE
+        serialize = partial(serialize_solutions_ndjson, result.variables)
+    else:
+        mime_type = _rdf_mime_type(format, accept)
+        serialize = partial(serialize_triples, mime_type=mime_type)
+    # The frame of this handler may outlive the request (rdflib's parser leaves
+    # it in a reference cycle), so make the stream the only owner of the results.
+    try:
+        body = _stream_results(query, result, serialize, start)
+    except Exception as e:
+        logger.exception("Query evaluation failed")
+        raise HTTPException(HTTP_500_INTERNAL_SERVER_ERROR, str(e))
+    finally:
+        del result
+    return StreamingResponse(body, media_type=mime_type)
+
+
+_SEARCH_RESPONSES: Dict[int | str, Dict[str, Any]] = {
+    200: {
+        "description": (
+            "SPARQL-JSON results for SELECT (newline-delimited and streamed if "
+            f"`{NDJSON_MIME_TYPE}` is accepted), `{{head, boolean}}` for ASK "
+            "and streamed RDF for CONSTRUCT and DESCRIBE."
+        ),
+        "content": {
+            mime_type: {} for mime_type in [NDJSON_MIME_TYPE, *RDF_MIME_TYPES.values()]
+        },
+    }
+}
+
+
+@router.get(
+    "/api/v0/graph",
+    response_model=SearchResponse,
+    responses=_SEARCH_RESPONSES,
+)
+async def search_graph(
+    query: SearchSPARQLQuery,
+    format: RDFFormat = None,
+    accept: Annotated[str | None, Header()] = None,
+) -> Response | SearchResponse:
+    """Execute SPARQL query and return SPARQL-JSON results or RDF triples."""
+    return _search(query, format, accept)
+
+
+@router.post(
+    "/api/v0/graph/query",
+    response_model=SearchResponse,
+    responses=_SEARCH_RESPONSES,
+)
+async def search_graph_post(
+    query: SearchSPARQLQueryBody,
+    format: RDFFormat = None,
+    accept: Annotated[str | None, Header()] = None,
+) -> Response | SearchResponse:
+    """Execute SPARQL query sent in the request body, for queries too long for URLs."""
+
+    if "query" not in query or len(query) != 1 or not isinstance(query["query"], str):
+        logger.error("Request must contain only {'query': str}")
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST, "Request must contain only {'query': str}"
+        )
+
+    return _search(query["query"], format, accept)
+
 
 def _execute_update_query(query):
     valid, msg = store.validate_sparql(query, "update")
 
     if valid:
         try:
-            _sparql_with_retry(lambda: store.update_query(query), "SPARQL update")
+            _, start = _sparql_with_retry(
+                lambda: store.update_query(query), "SPARQL update", query, "update"
+            )
         except Exception as e:
             raise HTTPException(HTTP_500_INTERNAL_SERVER_ERROR, str(e))
+        query_stats.record(query, "update", (perf_counter() - start) * 1000)
 
         logger.debug(f'Performed "{query}".')
     else:
@@ -219,3 +474,264 @@ async def perform_compaction() -> str:
     except Exception as e:
         logger.exception("An unexpected error occurred during optimization.")
         raise HTTPException(HTTP_500_INTERNAL_SERVER_ERROR, str(e))
+
+
+async def _stream_on_event_loop(chunks: Iterator[bytes]) -> AsyncIterator[bytes]:
+    # See `_stream_results`: pyoxigraph iterators are bound to their thread.
+    for chunk in chunks:
+        yield chunk
+
+
+@store_router.get(
+    "/api/v0/store/export",
+    response_class=StreamingResponse,
+    responses={200: {"content": {NQUADS_MIME_TYPE: {}}}},
+)
+async def export_store(graphs: ExportGraphs = None) -> StreamingResponse:
+    """Stream a dump of the whole store or of the given graphs as N-Quads."""
+    return StreamingResponse(
+        _stream_on_event_loop(store.export_nquads(graphs)),
+        media_type=NQUADS_MIME_TYPE,
+    )
+
+
+@store_router.post(
+    "/api/v0/store/backup",
+)
+async def backup_store() -> str:
+    """Create an online backup (RocksDB checkpoint) of the persistent store."""
+    if not BACKUP_PATH:
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST, "Backups require a persistent store (STORE_PATH)."
+        )
+    target = path.join(BACKUP_PATH, f"backup-{int(time() * 1000)}")
+    makedirs(BACKUP_PATH, exist_ok=True)
+    try:
+        await run_in_threadpool(store.backup, target)
+    except ValueError as e:
+        raise HTTPException(HTTP_400_BAD_REQUEST, str(e))
+    except Exception as e:
+        logger.exception("Backup failed")
+        raise HTTPException(HTTP_500_INTERNAL_SERVER_ERROR, str(e))
+    return f"Success - Backup created at {target}."
+
+
+@store_router.post(
+    "/api/v0/store/restore",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {NQUADS_MIME_TYPE: {"schema": {"type": "string"}}},
+        }
+    },
+)
+async def restore_store(request: Request, replace: bool = False) -> str:
+    """Bulk load an N-Quads dump, optionally replacing the current content."""
+    # Spool next to the backups: a dump of a persistent store may not fit in /tmp.
+    if BACKUP_PATH:
+        makedirs(BACKUP_PATH, exist_ok=True)
+    with NamedTemporaryFile(suffix=".nq", dir=BACKUP_PATH) as spool:
+        async for chunk in request.stream():
+            spool.write(chunk)
+        spool.flush()
+        try:
+            await run_in_threadpool(store.restore, spool.name, replace=replace)
+        except SyntaxError as e:
+            logger.error(f"Invalid N-Quads dump: {e}")
+            raise HTTPException(HTTP_400_BAD_REQUEST, str(e))
+        except Exception as e:
+            logger.exception("Restore failed")
+            raise HTTPException(HTTP_500_INTERNAL_SERVER_ERROR, str(e))
+    logger.info("Restored the graph store from an N-Quads dump.")
+    return "Success"
+
+
+@store_router.post(
+    "/api/v0/store/rollup",
+)
+async def rollup_store(body: RollupRequest) -> RollupResponse:
+    """
+    Merge aging snapshot graphs into coarser rollup graphs, e.g. per-minute
+    snapshots older than an hour into hourly rollups.
+    """
+    tiers = [RollupTier(**tier.model_dump()) for tier in body.tiers]
+    try:
+        results = await run_in_threadpool(store.rollup, tiers)
+    except ValueError as e:
+        raise HTTPException(HTTP_400_BAD_REQUEST, str(e))
+    expired = 0
+    if body.retention_ms:
+        expired = await run_in_threadpool(
+            store.drop_expired_rollups, int(time() * 1000) - body.retention_ms
+        )
+    return RollupResponse(
+        tiers=[RollupTierResult(**asdict(result)) for result in results],
+        expired_graphs=expired,
+    )
+
+
+@monitoring_router.get(
+    "/api/v0/stats/queries",
+)
+async def get_query_stats(
+    limit: Annotated[int, Query(ge=1)] = 20,
+    sort_by: QueryStatsSortKey = "total_time_ms",
+) -> QueryStatsResponse:
+    """List the most expensive SPARQL query fingerprints."""
+    return QueryStatsResponse(
+        slow_query_threshold_ms=query_stats.slow_query_threshold_ms,
+        queries=[
+            QueryStatsItem(mean_time_ms=entry.mean_time_ms, **asdict(entry))
+            for entry in query_stats.top(limit, sort_by)
+        ],
+    )
+
+
+@monitoring_router.delete(
+    "/api/v0/stats/queries",
+)
+async def reset_query_stats() -> str:
+    """Reset the collected SPARQL query statistics."""
+    query_stats.reset()
+    return "Success"
+
+
+@monitoring_router.get(
+    "/api/v0/stats/store",
+)
+async def get_store_stats(include_graphs: bool = False) -> StoreStatsResponse:
+    """Return incrementally maintained statistics of the graph store."""
+    # Only scans the store if the statistics are unknown; keep it off the loop.
+    stats = await run_in_threadpool(store.statistics)
+    oldest, newest = stats.timestamp_range()
+    return StoreStatsResponse(
+        total_quads=stats.total_quads,
+        graph_count=stats.graph_count,
+        default_graph_triples=stats.default_graph_triples,
+        oldest_timestamp=oldest,
+        newest_timestamp=newest,
+        graphs_by_resource=stats.graphs_by_resource(),
+        graph_triples=stats.graph_triples() if include_graphs else None,
+    )
+
+
+@monitoring_router.get(
+    "/ready",
+    responses={HTTP_503_SERVICE_UNAVAILABLE: {"model": ReadinessResponse}},
+)
+async def readiness(response: Response) -> ReadinessResponse:
+    """Report whether the store is open and the startup warmup has finished."""
+    if not startup_state.ready:
+        response.status_code = HTTP_503_SERVICE_UNAVAILABLE
+    return ReadinessResponse(ready=startup_state.ready, phases=startup_state.phases)
+
+
+def _is_admin(token: Optional[str]) -> bool:
+    return bool(
+        PROFILING_ENABLED
+        and ADMIN_TOKEN
+        and token is not None
+        and compare_digest(token, ADMIN_TOKEN)
+    )
+
+
+async def _require_admin(
+    x_admin_token: Annotated[Optional[str], Header()] = None,
+) -> None:
+    # Hide the admin endpoints entirely unless profiling is switched on.
+    if not PROFILING_ENABLED or not ADMIN_TOKEN:
+        raise HTTPException(HTTP_404_NOT_FOUND, "Not Found")
+    if not _is_admin(x_admin_token):
+        raise HTTPException(HTTP_403_FORBIDDEN, "Invalid admin token")
+
+
+admin_router = APIRouter(tags=[TagEnum.ADMIN], dependencies=[Depends(_require_admin)])
+
+
+class ProfileRequestMiddleware:
+    """
+    Sample-profile one request sent with `X-Profile-Request: true`.
+
+    The response body is replaced by the folded stacks of the request;
+    the original status code is returned in `X-Profiled-Status`.
+    A plain ASGI middleware, so other requests are passed through untouched.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not PROFILING_ENABLED:
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        if headers.get("x-profile-request", "").lower() != "true" or not _is_admin(
+            headers.get("x-admin-token")
+        ):
+            return await self.app(scope, receive, send)
+
+        status_code = HTTP_500_INTERNAL_SERVER_ERROR
+
+        async def discard(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+
+        # Streamed responses do their work while the body is sent. Only the
+        # thread serving this request is sampled, not the concurrent ones.
+        with StackSampler(thread_ids={threading.get_ident()}) as sampler:
+            await self.app(scope, receive, discard)
+        response = PlainTextResponse(
+            sampler.folded(), headers={"X-Profiled-Status": str(status_code)}
+        )
+        await response(scope, receive, send)
+
+
+@admin_router.post(
+    "/api/v0/admin/profile",
+    response_class=PlainTextResponse,
+)
+async def profile_process(
+    seconds: Annotated[float, Query(gt=0, le=300)] = 10,
+    interval_ms: Annotated[float, Query(ge=1, le=1000)] = 5,
+) -> str:
+    """
+    Sample the stacks of all threads for `seconds` and return them in the
+    folded format of flamegraph.pl and speedscope.
+    """
+    with StackSampler(interval_ms / 1000) as sampler:
+        await asyncio.sleep(seconds)
+    return sampler.folded()
+
+
+@admin_router.post(
+    "/api/v0/admin/tracemalloc/start",
+)
+async def start_allocation_tracking(
+    frames: Annotated[int, Query(ge=1, le=50)] = 1,
+) -> str:
+    """Start recording the allocations of the ingest and query stages."""
+    if tracemalloc.is_tracing():
+        raise HTTPException(HTTP_409_CONFLICT, "tracemalloc is already tracing")
+    store.allocations.start(frames)
+    return "Success"
+
+
+@admin_router.post(
+    "/api/v0/admin/tracemalloc/stop",
+)
+async def stop_allocation_tracking() -> str:
+    """Stop recording allocations; the collected records are kept."""
+    if store.allocations.active:
+        store.allocations.stop()
+    return "Success"
+
+
+@admin_router.get(
+    "/api/v0/admin/tracemalloc",
+)
+async def get_allocations() -> AllocationsResponse:
+    """Return the allocation records of the most recent stages."""
+    return AllocationsResponse(
+        active=store.allocations.active,
+        records=[AllocationRecord(**r) for r in list(store.allocations.records)],
+    )
@@ -1,7 +1,7 @@
-from typing import Annotated, Any, Dict
+from typing import Annotated, Any, Dict, Literal, Optional
 
 from fastapi import Body, Query
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class ResponseHead(BaseModel):
@@ -57,6 +57,89 @@ class SearchResponse(BaseModel):
         }
 
 
+class AskResponse(BaseModel):
+    head: Dict[str, Any]
+    boolean: bool
+
+
+class QueryStatsItem(BaseModel):
+    fingerprint: str
+    kind: str
+    normalized_query: str
+    calls: int
+    errors: int
+    rows: int
+    total_time_ms: float
+    max_time_ms: float
+    mean_time_ms: float
+
+
+class QueryStatsResponse(BaseModel):
+    slow_query_threshold_ms: float
+    queries: list[QueryStatsItem]
+
+
+class StoreStatsResponse(BaseModel):
+    total_quads: int
+    graph_count: int
+    default_graph_triples: int
+    oldest_timestamp: Optional[int]
+    newest_timestamp: Optional[int]
+    graphs_by_resource: Dict[str, int]
+    graph_triples: Optional[Dict[str, int]] = None
+
+
+class ReadinessResponse(BaseModel):
+    ready: bool
+    phases: Dict[str, float]
+
+
+class RollupTierModel(BaseModel):
+    older_than_ms: int = Field(ge=0)
+    resolution_ms: int = Field(gt=0)
+
+
+class RollupRequest(BaseModel):
+    tiers: list[RollupTierModel]
+    retention_ms: Optional[int] = Field(
+        default=None,
+        gt=0,
+        description="Drop the rollup graphs whose bucket ended longer ago than this.",
+    )
+
+
+class RollupTierResult(BaseModel):
+    resolution_ms: int
+    source_graphs: int
+    rollup_graphs: int
+    source_triples: int
+    rollup_triples: int
+
+
+class RollupResponse(BaseModel):
+    tiers: list[RollupTierResult]
+    expired_graphs: int
+
+
+class AllocationStat(BaseModel):
+    location: str
+    size_diff_bytes: int
+    count_diff: int
+
+
+class AllocationRecord(BaseModel):
+    stage: str
+    timestamp: int
+    size_diff_bytes: int
+    peak_bytes: int
+    top: list[AllocationStat]
+
+
+class AllocationsResponse(BaseModel):
+    active: bool
+    records: list[AllocationRecord]
+
+
 UpdateRequestBody = Annotated[
     dict[str, Any],
     Body(
@@ -77,6 +160,48 @@ SPARQLQuery = Annotated[
     ),
 ]
 
+ExportGraphs = Annotated[
+    Optional[list[str]],
+    Query(
+        alias="graph",
+        description=(
+            "Named graph IRI to export. Can be repeated. "
+            "The whole store is exported if omitted."
+        ),
+    ),
+]
+
+SearchSPARQLQuery = Annotated[
+    str,
+    Query(
+        description=(
+            "SELECT, CONSTRUCT, DESCRIBE or ASK query in SPARQL language. "
+            "It must be compatible with GLACIATION metadata upper ontology."
+        ),
+    ),
+]
+
+SearchSPARQLQueryBody = Annotated[
+    dict[str, Any],
+    Body(
+        description=(
+            "SELECT, CONSTRUCT, DESCRIBE or ASK query in SPARQL language "
+            "as {'query': str}. "
+            "It must be compatible with GLACIATION metadata upper ontology."
+        ),
+    ),
+]
+
+RDFFormat = Annotated[
+    Optional[Literal["ntriples", "turtle", "jsonld"]],
+    Query(
+        description=(
+            "Serialization of CONSTRUCT and DESCRIBE results. "
+            "Defaults to the Accept header, then to N-Triples."
+        ),
+    ),
+]
+
 UpdateSPARQLQuery = Annotated[
     dict[str, Any],
     Body(
@@ -0,0 +1,128 @@
+# the script talks to metadata service directly
+# it exports, backs up and restores the graph store
+
+from typing import List, Optional
+
+import argparse
+import sys
+from os import getenv
+from time import perf_counter
+
+import requests
+from loguru import logger
+
+METADATA_SERVICE_URL = getenv("METADATA_SERVICE_URL", "http://localhost:80")
+NQUADS_MIME_TYPE = "application/n-quads"
+_REQUEST_TIMEOUT = int(float(getenv("REQUEST_TIMEOUT_SECONDS", "30")))
+_RESTORE_TIMEOUT = int(float(getenv("RESTORE_TIMEOUT_SECONDS", "3600")))
+_CHUNK_SIZE = 1 << 20
+
+
+def export_store(output: str, graphs: Optional[List[str]] = None) -> None:
+    """
+    Streams an N-Quads dump of the store (or of the given graphs) into a file
+    """
+    start = perf_counter()
+    n_bytes = 0
+    with requests.get(
+        f"{METADATA_SERVICE_URL}/api/v0/store/export",
+        params={"graph": graphs} if graphs else None,
+        stream=True,
+        timeout=_REQUEST_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        with open(output, "wb") as f:
+            for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+                f.write(chunk)
+                n_bytes += len(chunk)
+    logger.info(
+        f"Exported {n_bytes} byte(s) into {output} in {perf_counter() - start:.1f} s."
+    )
+
+
+def backup_store() -> None:
+    """
+    Creates an online backup of the persistent store next to it
+    """
+    response = requests.post(
+        f"{METADATA_SERVICE_URL}/api/v0/store/backup", timeout=_REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+    logger.info(response.json())
+
+
+def restore_store(
+    input: str, replace: bool = False, store_path: Optional[str] = None
+) -> None:
+    """
+    Bulk loads an N-Quads dump into the running service or,
+    with `store_path`, directly into a store that is not opened by the service
+    """
+    start = perf_counter()
+    if store_path:
+        import pyoxigraph
+
+        # Validate the whole dump before clearing anything.
+        for _ in pyoxigraph.parse(input, NQUADS_MIME_TYPE):
+            pass
+        store = pyoxigraph.Store(store_path)
+        if replace:
+            store.clear()
+        store.bulk_load(input, NQUADS_MIME_TYPE)
+        store.optimize()
+    else:
+        with open(input, "rb") as f:
+            response = requests.post(
+                f"{METADATA_SERVICE_URL}/api/v0/store/restore",
+                params={"replace": replace},
+                data=f,
+                headers={"Content-Type": NQUADS_MIME_TYPE},
+                timeout=_RESTORE_TIMEOUT,
+            )
+        response.raise_for_status()
+    logger.info(f"Restored {input} in {perf_counter() - start:.1f} s.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="snapshot.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Dump the store as N-Quads")
+    export_parser.add_argument("output", help="Output .nq file")
+    export_parser.add_argument(
+        "--graph",
+        action="append",
+        help="Named graph IRI to export; can be repeated (default: all graphs)",
+    )
+
+    subparsers.add_parser("backup", help="Online backup of the persistent store")
+
+    restore_parser = subparsers.add_parser("restore", help="Bulk load an N-Quads dump")
+    restore_parser.add_argument("input", help="Input .nq file")
+    restore_parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="Clear the store before loading",
+    )
+    restore_parser.add_argument(
+        "--store-path",
+        default=None,
+        help="Load directly into this store directory (the service must be stopped)",
+    )
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == "export":
+            export_store(args.output, args.graph)
+        elif args.command == "backup":
+            backup_store()
+        else:
+            restore_store(args.input, args.replace, args.store_path)
+    except Exception as e:
+        logger.error(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
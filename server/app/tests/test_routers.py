@@ -1,17 +1,42 @@
-from json import load
+from typing import Any, Dict, Tuple
 
+import threading
+from json import dumps, load, loads
+from pathlib import Path
+from time import sleep
+
+import pytest
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
-from starlette.status import HTTP_200_OK, HTTP_303_SEE_OTHER, HTTP_400_BAD_REQUEST
+from starlette.status import (
+    HTTP_200_OK,
+    HTTP_303_SEE_OTHER,
+    HTTP_400_BAD_REQUEST,
+    HTTP_403_FORBIDDEN,
+    HTTP_404_NOT_FOUND,
+    HTTP_422_UNPROCESSABLE_ENTITY,
+    HTTP_500_INTERNAL_SERVER_ERROR,
+    HTTP_503_SERVICE_UNAVAILABLE,
+)
 
 from app import routers
+from app.Profiling import AllocationTracker
 
 app = FastAPI()
 app.include_router(routers.router)
+app.include_router(routers.monitoring_router)
+app.include_router(routers.store_router)
+app.include_router(routers.admin_router)
+app.add_middleware(routers.ProfileRequestMiddleware)
 
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def history_files_dirname(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(routers, "HISTORY_FILES_DIRNAME", f"{tmp_path}/")
+
+
 def test__read_root__redirected() -> None:
     response = client.get("/", follow_redirects=False)
     assert response.status_code == HTTP_303_SEE_OTHER
@@ -63,3 +88,471 @@ def test__search_graph__redirected() -> None:
         },
     )
     assert response.status_code == HTTP_400_BAD_REQUEST
+
+
+def test__get_query_stats__aggregated_by_fingerprint() -> None:
+    client.delete("/api/v0/stats/queries")
+    for graph in ["urn:a", "urn:b"]:
+        response = client.get(
+            "/api/v0/graph",
+            params={"query": f"SELECT ?s WHERE {{ GRAPH <{graph}> {{ ?s ?p 1 }} }}"},
+        )
+        assert response.status_code == HTTP_200_OK
+
+    response = client.get("/api/v0/stats/queries", params={"sort_by": "calls"})
+    assert response.status_code == HTTP_200_OK
+    queries = response.json()["queries"]
+    assert len(queries) == 1
+    assert queries[0]["kind"] == "query"
+    assert queries[0]["calls"] == 2
+    assert queries[0]["errors"] == 0
+    assert queries[0]["normalized_query"] == (
+        "SELECT ?s WHERE { GRAPH <?> { ?s ?p ? } }"
+    )
+
+
+def test__get_query_stats__retries_not_timed(monkeypatch: pytest.MonkeyPatch) -> None:
+    client.delete("/api/v0/stats/queries")
+    monkeypatch.setattr(routers, "_RETRY_BASE_DELAY", 0.5)
+    update_query = routers.store.update_query
+    attempts = []
+
+    def flaky_update_query(query: str) -> None:
+        attempts.append(query)
+        if len(attempts) == 1:
+            raise OSError("transient")
+        update_query(query)
+
+    monkeypatch.setattr(routers.store, "update_query", flaky_update_query)
+    response = client.post(
+        "/api/v0/graph/update", json={"query": "DROP SILENT GRAPH <urn:flaky>"}
+    )
+    assert response.status_code == HTTP_200_OK
+
+    (entry,) = client.get("/api/v0/stats/queries").json()["queries"]
+    assert (entry["calls"], entry["errors"]) == (2, 1)
+    assert entry["max_time_ms"] < 500
+
+    response = client.get("/api/v0/stats/queries", params={"limit": -1})
+    assert response.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test__readiness__after_warmup() -> None:
+    routers.startup_state.ready = False
+    response = client.get("/ready")
+    assert response.status_code == HTTP_503_SERVICE_UNAVAILABLE
+    assert response.json()["ready"] is False
+
+    routers.warmup_parsers()
+    routers.warmup()
+    response = client.get("/ready")
+    assert response.status_code == HTTP_200_OK
+    assert response.json()["ready"] is True
+    assert {"warmup_parsers", "warmup_queries", "total"} <= set(
+        response.json()["phases"]
+    )
+
+
+def test__lifespan__queries_served_during_warmup(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    from app import main
+
+    warming_up = threading.Event()
+    release = threading.Event()
+    read_query = routers.store.read_query
+
+    def blocking_read_query(query: str) -> Dict[str, Any]:
+        warming_up.set()
+        release.wait(10)
+        return read_query(query)
+
+    monkeypatch.setattr(routers, "WARMUP_ON_STARTUP", True)
+    monkeypatch.setattr(routers.store, "read_query", blocking_read_query)
+    routers.startup_state.ready = False
+    try:
+        with TestClient(main.app) as app_client:
+            assert warming_up.wait(10)
+            response = app_client.get(
+                "/api/v0/graph", params={"query": "SELECT * WHERE { ?s ?p ?o }"}
+            )
+            assert response.status_code == HTTP_200_OK
+            assert app_client.get("/ready").status_code == HTTP_503_SERVICE_UNAVAILABLE
+            release.set()
+    finally:
+        release.set()
+
+
+def test__get_store_stats__maintained_incrementally() -> None:
+    routers.store.rebuild_statistics()
+    before = client.get("/api/v0/stats/store").json()
+
+    with open("app/tests/stub_message.jsonld", "r") as f:
+        json_input = load(f)
+    response = client.patch("/api/v0/graph", json=json_input)
+    assert response.status_code == HTTP_200_OK
+    graph_name = response.json().split("<")[-1].split(">")[0]
+    resource, _, timestamp = graph_name.rpartition("timestamp:")
+    resource = resource.rstrip("/")
+
+    response = client.get("/api/v0/stats/store", params={"include_graphs": True})
+    assert response.status_code == HTTP_200_OK
+    stats = response.json()
+    assert stats["graph_count"] == before["graph_count"] + 1
+    assert stats["newest_timestamp"] == int(timestamp)
+    assert stats["graphs_by_resource"][resource] == (
+        before["graphs_by_resource"].get(resource, 0) + 1
+    )
+    n_triples = stats["graph_triples"][graph_name]
+    assert stats["total_quads"] == before["total_quads"] + n_triples
+
+    client.get("/api/v0/graph/update", params={"query": f"DROP GRAPH <{graph_name}>"})
+    stats = client.get("/api/v0/stats/store").json()
+    assert stats["total_quads"] == before["total_quads"]
+    assert stats["graph_count"] == before["graph_count"]
+
+    routers.store.rebuild_statistics()
+    assert client.get("/api/v0/stats/store").json() == stats
+
+
+def _wait_for_statistics() -> None:
+    for thread in threading.enumerate():
+        if thread.name == "store-statistics-rebuild":
+            thread.join()
+
+
+def test__store_stats__rebuilt_after_invalidation() -> None:
+    store = routers.store
+    store.rebuild_statistics()
+    client.post(
+        "/api/v0/graph/update",
+        json={"query": "COPY DEFAULT TO <urn:copy>; DROP SILENT GRAPH <urn:copy>"},
+    )
+    client.post(
+        "/api/v0/graph/update",
+        json={"query": "INSERT DATA { GRAPH <urn:copy> { <urn:s> <urn:p> 1 } }"},
+    )
+    _wait_for_statistics()
+    assert store.stats.initialized
+    assert store.stats.total_quads == len(list(store.store))
+
+
+def test__store_stats__iris_and_literals_not_keywords() -> None:
+    store = routers.store
+    store.rebuild_statistics()
+    client.post(
+        "/api/v0/graph/update",
+        json={
+            "query": "INSERT DATA { GRAPH <https://k8s/default/pod> "
+            '{ <urn:s> <urn:p> "Add all nodes" } }'
+        },
+    )
+    assert store.stats.initialized
+    assert store.stats.graph_triples()["https://k8s/default/pod"] == 1
+    client.post(
+        "/api/v0/graph/update", json={"query": "DROP GRAPH <https://k8s/default/pod>"}
+    )
+    assert store.stats.initialized
+
+
+def test__lifespan__statistics_built_without_warmup(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    from app import main
+
+    monkeypatch.setattr(routers, "WARMUP_ON_STARTUP", False)
+    routers.store.stats.invalidate()
+    with TestClient(main.app) as app_client:
+        assert app_client.get("/ready").status_code == HTTP_200_OK
+        _wait_for_statistics()
+        assert routers.store.stats.initialized
+
+
+def test__store_stats__writes_during_rebuild(monkeypatch: pytest.MonkeyPatch) -> None:
+    store = routers.store
+    scan_statistics = store._scan_statistics
+
+    def scan_then_write() -> Tuple[Dict[str, int], int]:
+        result = scan_statistics()
+        # Writes the scan has not seen...
+        client.post(
+            "/api/v0/graph/update",
+            json={"query": "INSERT DATA { GRAPH <urn:late> { <urn:s> <urn:p> 1 } }"},
+        )
+        # ...and a drop of a graph it has counted.
+        client.post("/api/v0/graph/update", json={"query": "DROP GRAPH <urn:copy>"})
+        return result
+
+    monkeypatch.setattr(store, "_scan_statistics", scan_then_write)
+    store.rebuild_statistics()
+    graphs = store.stats.graph_triples()
+    assert graphs["urn:late"] == 1
+    assert "urn:copy" not in graphs
+    assert store.stats.total_quads == len(list(store.store))
+
+
+def test__search_graph__construct_error_before_headers(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    def evaluate(solution: Any) -> Any:
+        raise RuntimeError("evaluation failed")
+
+    # Triples evaluated lazily, like pyoxigraph's QueryTriples.
+    monkeypatch.setattr(routers.store, "query", lambda *_: map(evaluate, [None]))
+    response = client.get(
+        "/api/v0/graph",
+        params={"query": "CONSTRUCT { ?s ?p ?o } WHERE { ?s ?p ?o }"},
+    )
+    assert response.status_code == HTTP_500_INTERNAL_SERVER_ERROR
+    assert response.json()["detail"] == "evaluation failed"
+
+
+def test__search_graph__construct_ask() -> None:
+    with open("app/tests/stub_message.jsonld", "r") as f:
+        json_input = load(f)
+    client.patch("/api/v0/graph", json=json_input)
+    construct = "CONSTRUCT { ?s ?p ?o } WHERE { GRAPH ?g { ?s ?p ?o } } LIMIT 3"
+
+    response = client.get("/api/v0/graph", params={"query": construct})
+    assert response.status_code == HTTP_200_OK
+    assert response.headers["content-type"].startswith("application/n-triples")
+    assert len(response.text.strip().split("\n")) == 3
+
+    response = client.get(
+        "/api/v0/graph",
+        params={"query": construct},
+        headers={"Accept": "text/turtle"},
+    )
+    assert response.headers["content-type"].startswith("text/turtle")
+
+    response = client.get(
+        "/api/v0/graph", params={"query": construct, "format": "jsonld"}
+    )
+    assert response.headers["content-type"].startswith("application/ld+json")
+    nodes = response.json()
+    assert len(nodes) == 3
+    assert all("@id" in node for node in nodes)
+
+    response = client.get(
+        "/api/v0/graph", params={"query": "ASK { GRAPH ?g { ?s ?p ?o } }"}
+    )
+    assert response.status_code == HTTP_200_OK
+    assert response.json() == {"head": {}, "boolean": True}
+
+
+def test__export_restore_store__round_trip() -> None:
+    with open("app/tests/stub_message.jsonld", "r") as f:
+        json_input = load(f)
+    response = client.patch("/api/v0/graph", json=json_input)
+    graph_name = response.json().split("<")[-1].split(">")[0]
+
+    response = client.get("/api/v0/store/export", params={"graph": graph_name})
+    assert response.status_code == HTTP_200_OK
+    assert response.headers["content-type"].startswith("application/n-quads")
+    dump = response.content
+    lines = dump.decode().splitlines()
+    assert all(line.endswith(f"<{graph_name}> .") for line in lines)
+
+    client.get("/api/v0/graph/update", params={"query": f"DROP GRAPH <{graph_name}>"})
+    response = client.post(
+        "/api/v0/store/restore",
+        content=dump,
+        headers={"Content-Type": "application/n-quads"},
+    )
+    assert response.status_code == HTTP_200_OK
+    stats = client.get("/api/v0/stats/store", params={"include_graphs": True}).json()
+    assert stats["graph_triples"][graph_name] == len(lines)
+
+    n_quads = len(list(routers.store.store))
+    response = client.post(
+        "/api/v0/store/restore", params={"replace": True}, content=dump + b"garbage"
+    )
+    assert response.status_code == HTTP_400_BAD_REQUEST
+    assert len(list(routers.store.store)) == n_quads
+
+    response = client.post("/api/v0/store/backup")
+    assert response.status_code == HTTP_400_BAD_REQUEST
+
+
+def test__search_graph_post__streamed_select() -> None:
+    with open("app/tests/stub_message.jsonld", "r") as f:
+        json_input = load(f)
+    client.patch("/api/v0/graph", json=json_input)
+    select = "SELECT ?s ?p ?o WHERE { GRAPH ?g { ?s ?p ?o } } LIMIT 3"
+
+    response = client.post("/api/v0/graph/query", json={"query": select})
+    assert response.status_code == HTTP_200_OK
+    assert len(response.json()["results"]["bindings"]) == 3
+
+    response = client.post(
+        "/api/v0/graph/query",
+        json={"query": select},
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert response.status_code == HTTP_200_OK
+    lines = [loads(line) for line in response.text.splitlines()]
+    assert lines[0] == {"head": {"vars": ["s", "p", "o"]}}
+    assert len(lines) == 4
+    assert all(set(binding) == {"s", "p", "o"} for binding in lines[1:])
+
+    response = client.post("/api/v0/graph/query", json={"select": select})
+    assert response.status_code == HTTP_400_BAD_REQUEST
+
+
+def test__admin_profiling(monkeypatch: pytest.MonkeyPatch) -> None:
+    assert client.post("/api/v0/admin/profile").status_code == HTTP_404_NOT_FOUND
+
+    monkeypatch.setattr(routers, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(routers, "ADMIN_TOKEN", "secret")
+    response = client.post("/api/v0/admin/profile", headers={"X-Admin-Token": "wrong"})
+    assert response.status_code == HTTP_403_FORBIDDEN
+
+    headers = {"X-Admin-Token": "secret"}
+    response = client.post(
+        "/api/v0/admin/profile",
+        params={"seconds": 0.1, "interval_ms": 1},
+        headers=headers,
+    )
+    assert response.status_code == HTTP_200_OK
+    assert response.text.endswith("\n")
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in response.text.splitlines())
+
+    response = client.get(
+        "/api/v0/graph",
+        params={"query": "SELECT * WHERE { ?s ?p ?o }"},
+        headers={**headers, "X-Profile-Request": "true"},
+    )
+    assert response.headers["X-Profiled-Status"] == "200"
+
+    try:
+        response = client.post("/api/v0/admin/tracemalloc/start", headers=headers)
+        assert response.status_code == HTTP_200_OK
+        with open("app/tests/stub_message.jsonld", "r") as f:
+            client.patch("/api/v0/graph", json=load(f))
+    finally:
+        client.post("/api/v0/admin/tracemalloc/stop", headers=headers)
+    response = client.get("/api/v0/admin/tracemalloc", headers=headers)
+    assert response.status_code == HTTP_200_OK
+    assert not response.json()["active"]
+    stages = {r["stage"] for r in response.json()["records"]}
+    assert "ingest_jsonld.parse" in stages
+
+
+def test__allocation_tracker__stop_during_stage() -> None:
+    tracker = AllocationTracker()
+    tracker.start()
+    entered = threading.Event()
+    errors = []
+
+    def run_stage() -> None:
+        try:
+            with tracker.stage("slow"):
+                entered.set()
+                sleep(0.1)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run_stage)
+    thread.start()
+    entered.wait()
+    tracker.stop()
+    thread.join()
+    assert not errors
+    assert [r["stage"] for r in tracker.records] == ["slow"]
+
+
+def test__rollup_store() -> None:
+    values = {1000: 1, 2000: 3, 61000: 8}
+    client.post(
+        "/api/v0/graph/update",
+        json={
+            "query": ";\n".join(
+                f"INSERT DATA {{ GRAPH <urn:rollup-test/timestamp:{ts}> {{ "
+                f'<urn:node> <urn:cpu> {value} ; <urn:name> "node" }} }}'
+                for ts, value in values.items()
+            )
+        },
+    )
+    old = 10**12  # the test graphs are from 1970
+    response = client.post(
+        "/api/v0/store/rollup",
+        json={
+            "tiers": [
+                {"older_than_ms": old, "resolution_ms": 3600000},
+                {"older_than_ms": old, "resolution_ms": 60000},
+            ]
+        },
+    )
+    assert response.status_code == HTTP_200_OK
+    minutes, hours = response.json()["tiers"]
+    assert (minutes["resolution_ms"], minutes["rollup_graphs"]) == (60000, 2)
+    assert hours["resolution_ms"] == 3600000
+
+    response = client.get(
+        "/api/v0/graph",
+        params={
+            "query": """
+            PREFIX r: <http://glaciation-project.eu/metadata-service/rollup#>
+            SELECT ?g ?name ?cpu ?min ?max ?avg ?count WHERE {
+                GRAPH ?g {
+                    <urn:node> <urn:name> ?name ; <urn:cpu> ?cpu ; r:aggregate ?a .
+                    ?a r:min ?min ; r:max ?max ; r:avg ?avg ; r:count ?count .
+                }
+                FILTER(STRSTARTS(STR(?g), "urn:rollup-test/"))
+            }
+            """
+        },
+    )
+    bindings = response.json()["results"]["bindings"]
+    assert len(bindings) == 1
+    row = {k: v["value"] for k, v in bindings[0].items()}
+    assert row["g"] == "urn:rollup-test/rollup:3600000/timestamp:0"
+    assert (row["name"], row["min"], row["max"], row["count"]) == (
+        "node",
+        "1",
+        "8",
+        "3",
+    )
+    assert float(row["avg"]) == float(row["cpu"]) == 4.0
+
+    response = client.post(
+        "/api/v0/store/rollup",
+        json={"tiers": [], "retention_ms": old},
+    )
+    assert response.json() == {"tiers": [], "expired_graphs": 1}
+    response = client.post(
+        "/api/v0/store/rollup",
+        json={
+            "tiers": [
+                {"older_than_ms": 0, "resolution_ms": 7},
+                {"older_than_ms": 0, "resolution_ms": 10},
+            ]
+        },
+    )
+    assert response.status_code == HTTP_400_BAD_REQUEST
+
+
+def test__rollup_store__not_larger_than_snapshots() -> None:
+    for i in range(5):
+        snapshot = {
+            "@context": {"gla": "http://glaciation-project.eu/model/"},
+            "@id": f"urn:rollup-nested/timestamp:{(i + 1) * 1000}",
+            "@graph": [
+                {
+                    "@id": "urn:pod",
+                    "@type": "gla:Pod",
+                    "gla:name": "pod",
+                    "gla:cpu": i,
+                    "gla:has-status": {"gla:phase": "Running", "gla:restarts": i},
+                }
+            ],
+        }
+        routers.store.ingest_jsonld(dumps(snapshot))
+    response = client.post(
+        "/api/v0/store/rollup",
+        json={"tiers": [{"older_than_ms": 10**12, "resolution_ms": 60000}]},
+    )
+    assert response.status_code == HTTP_200_OK
+    (tier,) = response.json()["tiers"]
+    assert tier["rollup_graphs"] >= 1
+    assert 0 < tier["rollup_triples"] <= tier["source_triples"]
@@ -64,6 +64,22 @@ class ArgsManager:
         return self._args
 
 
+def write_config(directory: str) -> str:
+    """
+    Write the generator config to `directory`, placing supporting files
+    without a folder inside the package.
+    """
+    with open(CONFIG_PATH, "r") as f:
+        config = json.load(f)
+    for options in config.get("files", {}).values():
+        if options.get("templateType") == "SupportingFiles":
+            options.setdefault("folder", config["packageName"])
+    config_path = os.path.join(directory, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=2)
+    return config_path
+
+
 def generate_openapi(
     file: str,
     volumes: Optional[Dict[str, str]] = None,
@@ -77,8 +93,6 @@ def generate_openapi(
         f"{CLIENT_DIR}:/project",
         "-v",
         f"{TEMPLATES_DIR}:/templates",
-        "-v",
-        f"{CONFIG_PATH}:/config.json",
     ]
     generator_args = [
         "openapitools/openapi-generator-cli:v7.3.0",
@@ -102,7 +116,11 @@ def generate_openapi(
     if use_asyncio:
         generator_args += ["--library", "asyncio"]
 
-    subprocess.run([*docker_args, *generator_args], stdout=subprocess.PIPE, check=True)
+    with tempfile.TemporaryDirectory() as config_dir:
+        docker_args += ["-v", f"{write_config(config_dir)}:/config.json"]
+        subprocess.run(
+            [*docker_args, *generator_args], stdout=subprocess.PIPE, check=True
+        )
 
 
 def main() -> None: